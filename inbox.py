@@ -1,20 +1,196 @@
 # aw_inbox/inbox.py
 
+import os
 import sqlite3
-import json
+import threading
+from contextlib import contextmanager
 from datetime import datetime, timezone
+from itertools import product, repeat
+
+import orjson
+
+_UTC = timezone.utc
+_EMPTY_TAGS_JSON = "[]"
+
+
+def _to_db(value):
+    # 本模块绑定的 datetime 统一在这里转成文本：带时区的转为 UTC，空格分隔的 ISO 格式与
+    # CURRENT_TIMESTAMP 及历史数据一致，可按文本排序；不带时区的原样保留（与旧的默认适配器相同）。
+    # 不使用 sqlite3.register_adapter，避免影响本进程中其他 sqlite3 连接
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(_UTC)
+        return value.isoformat(sep=' ')
+    return value
+
+
+def _convert_datetime(raw):
+    value = datetime.fromisoformat(raw.decode())
+    # CURRENT_TIMESTAMP 写入的值不带时区，但本身就是 UTC
+    return value.replace(tzinfo=_UTC) if value.tzinfo is None else value.astimezone(_UTC)
+
+
+# converter 注册表是进程级的：用私有名称注册，只由本模块查询里的列别名（PARSE_COLNAMES）选用，
+# 不影响其他连接读取 DATETIME 列
+sqlite3.register_converter("inbox_utc", _convert_datetime)
+
+_NOTE_COLUMNS = ('id, content, timestamp AS "timestamp [inbox_utc]", '
+                 'updated_at AS "updated_at [inbox_utc]", tags')
+# format='api' 时由 SQLite 直接输出 UTC ISO 8601 字符串，省去逐行构造 datetime
+_NOTE_API_COLUMNS = ("id, content, tags, "
+                     "strftime('%Y-%m-%dT%H:%M:%fZ', timestamp) AS timestamp, "
+                     "strftime('%Y-%m-%dT%H:%M:%fZ', updated_at) AS updated_at")
+
+
+def _build_get_notes_sql(has_tag, has_after, has_before, columns=_NOTE_COLUMNS):
+    conditions = []
+    if has_tag:
+        conditions.append('EXISTS (SELECT 1 FROM note_tags WHERE note_id = notes.id AND tag = ?)')
+    if has_after:
+        conditions.append('timestamp >= ?')
+    if has_before:
+        conditions.append('timestamp <= ?')
+    query = f"SELECT {columns} FROM notes"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    return query + " ORDER BY timestamp DESC LIMIT ?"
+
+
+# 按 (tag, created_after, created_before) 是否存在预先生成 SQL，保证同一种查询的语句文本完全一致，
+# 从而命中 sqlite3 的语句缓存
+_GET_NOTES_SQL = {key: _build_get_notes_sql(*key) for key in product((False, True), repeat=3)}
+_GET_NOTES_API_SQL = {key: _build_get_notes_sql(*key, columns=_NOTE_API_COLUMNS)
+                      for key in product((False, True), repeat=3)}
+_GET_NOTE_BY_ID_SQL = f"SELECT {_NOTE_COLUMNS} FROM notes WHERE id = ?"
+_INSERT_NOTE_SQL = "INSERT INTO notes (content, timestamp, updated_at, tags) VALUES (?, ?, ?, ?)"
+# RETURNING 需要 SQLite >= 3.35，更早的版本退回 lastrowid 再按 id 查询
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+_INSERT_NOTE_RETURNING_SQL = f"{_INSERT_NOTE_SQL} RETURNING {_NOTE_COLUMNS}"
+_FETCH_BATCH_SIZE = 128
+
+# 本进程内已执行过建表语句的数据库文件（绝对路径），同一文件只建一次表
+_INITIALIZED_DBS = set()
+_INITIALIZED_DBS_LOCK = threading.Lock()
+
+
+class _TagsCache:
+    # 按数据库文件共享的 get_all_tags 结果缓存；同一文件的所有 Inbox 实例共用一份
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = None
+        self.generation = 0
+        self.pending_writes = 0
+
+    def _invalidate(self):
+        self.generation += 1
+        self.value = None
+
+    @contextmanager
+    def writing(self):
+        # 写入开始和结束（包括回滚）时都清空缓存；写入进行期间读到的结果不会被缓存
+        with self.lock:
+            self.pending_writes += 1
+            self._invalidate()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.pending_writes -= 1
+                self._invalidate()
+
+    def get(self):
+        with self.lock:
+            return (None if self.value is None else list(self.value)), self.generation
+
+    def store(self, value, generation):
+        with self.lock:
+            if generation == self.generation and not self.pending_writes:
+                self.value = value
+
+
+_TAGS_CACHES = {}
+
+
+def _tags_cache_for(db_path):
+    with _INITIALIZED_DBS_LOCK:
+        return _TAGS_CACHES.setdefault(db_path, _TagsCache())
 
 class Inbox:
     def __init__(self, testing=False):
         self.db_file = 'inbox.db' if not testing else 'test_inbox.db'
-        self._create_table()
+        # 所有连接都用构造时的绝对路径打开，之后即使工作目录改变也指向同一个文件
+        self._db_path = db_path = os.path.abspath(self.db_file)
+        is_new_file = not os.path.exists(db_path)
+        # 复用同一个长连接，避免每次请求都重新打开数据库文件
+        self._conn = self._connect()
+        # iter_notes 专用的只读连接，首次使用时再打开
+        self._read_conn = None
+        self._read_conn_lock = threading.Lock()
+        self._write_lock = threading.Lock()  # 多线程下串行化写操作
+        self._tags_cache = _tags_cache_for(db_path)
+        try:
+            self._configure_connection(self._conn)
+            with _INITIALIZED_DBS_LOCK:
+                # 文件被删除后重建时需要重新建表
+                if is_new_file or db_path not in _INITIALIZED_DBS:
+                    self._create_table()
+                    _INITIALIZED_DBS.add(db_path)
+        except BaseException:
+            # 构造失败时调用方拿不到实例，无法 close()，这里关闭连接以免泄漏
+            self._conn.close()
+            raise
 
     def _get_conn(self):
-        return sqlite3.connect(self.db_file)
+        return self._conn
+
+    def _connect(self):
+        conn = sqlite3.connect(self._db_path, check_same_thread=False, cached_statements=256,
+                               detect_types=sqlite3.PARSE_COLNAMES)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _get_read_conn(self):
+        # 单独的锁：打开只读连接不必等待正在进行的写事务
+        with self._read_conn_lock:
+            if self._read_conn is None:
+                conn = self._connect()
+                self._configure_connection(conn)
+                conn.execute("PRAGMA query_only=ON")
+                self._read_conn = conn
+        return self._read_conn
+
+    def close(self):
+        self._conn.close()
+        if self._read_conn is not None:
+            self._read_conn.close()
+
+    @staticmethod
+    def _configure_connection(conn):
+        # 除 journal_mode 外这些 PRAGMA 都只对当前连接生效，每个连接都要设置
+        cursor = conn.cursor()
+        # WAL + synchronous=NORMAL：减少每次写入的 fsync 次数
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.execute("PRAGMA mmap_size=268435456")
+        cursor.execute("PRAGMA cache_size=-65536")
+        cursor.execute("PRAGMA foreign_keys=ON")
 
     def _create_table(self):
         conn = self._get_conn()
         cursor = conn.cursor()
+        # sqlite3 不会为 DDL 自动开启事务；显式 BEGIN 保证建表与回填要么全部生效，要么全部回滚，
+        # 否则回填失败后 note_tags 已存在，之后再也不会回填
+        cursor.execute("BEGIN")
+        try:
+            self._create_schema(cursor)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+
+    @staticmethod
+    def _create_schema(cursor):
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS notes (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -24,100 +200,162 @@ class Inbox:
                 tags TEXT
             )
         """)
-        conn.commit()
-        conn.close()
+        # get_notes 按 timestamp 倒序分页。updated_at 不建索引：没有查询按它排序或过滤，
+        # 索引只会拖慢每次 update_note
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_notes_timestamp ON notes(timestamp DESC)")
+        # 标签拆分到独立的关联表，避免每次查询都解析 tags 列的 JSON
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_tags'")
+        has_note_tags = cursor.fetchone() is not None
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS note_tags (
+                note_id INTEGER NOT NULL REFERENCES notes(id) ON DELETE CASCADE,
+                tag TEXT NOT NULL,
+                PRIMARY KEY (note_id, tag)
+            )
+        """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_note_tags_tag ON note_tags(tag)")
+        if not has_note_tags:
+            # 旧数据库：从已有笔记的 tags 列回填关联表；与原实现一致，只接受 JSON 数组，
+            # 非法或非数组的值直接跳过，避免初始化失败或被当作标签写入。
+            # 数组中的非字符串元素同样跳过，OR IGNORE 只用于忽略历史数据里重复的标签
+            cursor.execute("""
+                INSERT OR IGNORE INTO note_tags (note_id, tag)
+                SELECT notes.id, jt.value FROM notes, json_each(notes.tags) jt
+                WHERE json_valid(notes.tags) AND json_type(notes.tags) = 'array' AND jt.type = 'text'
+            """)
 
     def create_note(self, content, tags=None, created=None):
         conn = self._get_conn()
         cursor = conn.cursor()
-        timestamp = created.astimezone(timezone.utc) if created else datetime.now(timezone.utc)
-        tags_json = json.dumps(tags) if tags else None
-        cursor.execute("INSERT INTO notes (content, timestamp, updated_at, tags) VALUES (?, ?, ?, ?)",
-                       (content, timestamp, datetime.now(timezone.utc), tags_json))
-        note_id = cursor.lastrowid
-        conn.commit()
-        conn.close()
-        return self._get_note_by_id(note_id)
+        now = datetime.now(_UTC)
+        timestamp = created.astimezone(_UTC) if created else now
+        tags_json = orjson.dumps(tags).decode() if tags else None
+        unique_tags = self._unique_tags(tags) if tags else None
+        with self._write_lock, self._tags_cache.writing():
+            with conn:  # 笔记与标签在同一事务中写入，异常时整体回滚
+                params = (content, _to_db(timestamp), _to_db(now), tags_json)
+                if _HAS_RETURNING:
+                    # RETURNING 直接取回入库后的行，无需再按 id 查询一次
+                    cursor.execute(_INSERT_NOTE_RETURNING_SQL, params)
+                else:
+                    cursor.execute(_INSERT_NOTE_SQL, params)
+                    cursor.execute(_GET_NOTE_BY_ID_SQL, (cursor.lastrowid,))
+                row = cursor.fetchone()
+                if unique_tags:
+                    self._sync_note_tags(cursor, row[0], unique_tags, replace=False)
+        return self._row_to_note(row)
+
+    @staticmethod
+    def _unique_tags(tags):
+        # 在写入前校验并去重，之后用普通 INSERT：非法标签直接报错，
+        # 而不是被 OR IGNORE 吞掉，或被 TEXT 列悄悄转成字符串
+        if not all(isinstance(tag, str) for tag in tags):
+            raise TypeError("tags must be a list of strings")
+        return list(dict.fromkeys(tags))
+
+    @staticmethod
+    def _sync_note_tags(cursor, note_id, tags, replace=True):
+        # 调用方负责事务，tags 须已经过 _unique_tags；新建笔记时无旧标签，可跳过 DELETE
+        if replace:
+            cursor.execute("DELETE FROM note_tags WHERE note_id = ?", (note_id,))
+        cursor.executemany("INSERT INTO note_tags (note_id, tag) VALUES (?, ?)",
+                           zip(repeat(note_id), tags))
 
     def _get_note_by_id(self, note_id):
         conn = self._get_conn()
         cursor = conn.cursor()
-        cursor.execute("SELECT id, content, timestamp, updated_at, tags FROM notes WHERE id = ?", (note_id,))
+        cursor.execute(_GET_NOTE_BY_ID_SQL, (note_id,))
         row = cursor.fetchone()
-        conn.close()
-        if row:
-            return Note(row[0], row[1], datetime.fromisoformat(row[2]), datetime.fromisoformat(row[3]), json.loads(row[4]) if row[4] else [])
-        return None
+        return self._row_to_note(row) if row else None
+
+    @staticmethod
+    def _row_to_note(row):
+        return Note(row[0], row[1], row[2], row[3], orjson.loads(row[4]) if row[4] else [])
 
     def update_note(self, note_id, new_content=None, new_tags=None):
         conn = self._get_conn()
         cursor = conn.cursor()
-        updated_at = datetime.now(timezone.utc)
+        updated_at = datetime.now(_UTC)
         updates = []
         params = []
         if new_content is not None:
             updates.append("content = ?")
             params.append(new_content)
         if new_tags is not None:
+            unique_tags = self._unique_tags(new_tags)
             updates.append("tags = ?")
-            params.append(json.dumps(new_tags))
+            params.append(orjson.dumps(new_tags).decode() if new_tags else _EMPTY_TAGS_JSON)
         updates.append("updated_at = ?")
-        params.append(updated_at)
+        params.append(_to_db(updated_at))
         params.append(note_id)
 
-        if updates:
-            query = f"UPDATE notes SET {', '.join(updates)} WHERE id = ?"
-            cursor.execute(query, tuple(params))
-            conn.commit()
-            conn.close()
-            return self._get_note_by_id(note_id)
-        return self._get_note_by_id(note_id)
+        query = f"UPDATE notes SET {', '.join(updates)} WHERE id = ?"
+        with self._write_lock, self._tags_cache.writing():
+            with conn:
+                cursor.execute(query, tuple(params))
+                found = cursor.rowcount > 0
+                if found and new_tags is not None:
+                    self._sync_note_tags(cursor, note_id, unique_tags)
+        # 以 UPDATE 的受影响行数判断笔记是否存在，不存在时无需再查询
+        return self._get_note_by_id(note_id) if found else None
 
-    def get_notes(self, limit=50, tag=None, created_after=None, created_before=None):
-        conn = self._get_conn()
+    def get_notes(self, limit=50, tag=None, created_after=None, created_before=None, format=None):
+        # 默认返回 Note 列表；format='api' 时返回可直接序列化的 dict 列表，时间字段为 UTC ISO 字符串。
+        # 走主连接，保证能读到本实例刚提交的写入
+        return list(self._iter_notes(self._get_conn(), limit, tag, created_after, created_before, format))
+
+    def iter_notes(self, limit=50, tag=None, created_after=None, created_before=None, format=None):
+        # 与 get_notes 参数相同，但按批 fetchmany 逐条产出，内存占用与 limit 无关。
+        # 使用独立的只读连接：迭代期间读的是开始时已提交数据的快照，不会看到其他线程未提交的写入，
+        # 也不会因它们回滚而中止。快照会一直持有到迭代结束（同一实例上并发的其他迭代器共用它），
+        # 并阻止 WAL checkpoint 回收，因此调用方应尽快消费完或 close() 迭代器
+        return self._iter_notes(self._get_read_conn(), limit, tag, created_after, created_before, format)
+
+    def _iter_notes(self, conn, limit, tag, created_after, created_before, format):
         cursor = conn.cursor()
-        query = "SELECT id, content, timestamp, updated_at, tags FROM notes"
-        conditions = []
+        cursor.arraysize = _FETCH_BATCH_SIZE
         params = []
-
         if tag:
-            conditions.append('JSON_CONTAINS(tags, JSON(?))')
-            params.append(json.dumps([tag]))  # 将标签包装成 JSON 数组进行匹配
-
+            params.append(tag)
         if created_after:
-            conditions.append('timestamp >= ?')
-            params.append(created_after)
+            params.append(_to_db(created_after))
         if created_before:
-            conditions.append('timestamp <= ?')
-            params.append(created_before)
-
-        if conditions:
-            query += " WHERE " + " AND ".join(conditions)
-
-        query += " ORDER BY timestamp DESC LIMIT ?"
+            params.append(_to_db(created_before))
         params.append(limit)
 
-        cursor.execute(query, tuple(params))
-        rows = cursor.fetchall()
-        conn.close()
-        return [Note(row[0], row[1], datetime.fromisoformat(row[2]), datetime.fromisoformat(row[3]), json.loads(row[4]) if row[4] else []) for row in rows]
+        key = (bool(tag), bool(created_after), bool(created_before))
+        try:
+            if format == 'api':
+                cursor.execute(_GET_NOTES_API_SQL[key], tuple(params))
+                for rows in iter(cursor.fetchmany, []):
+                    for row in rows:
+                        yield {'id': row['id'], 'content': row['content'],
+                               'tags': orjson.loads(row['tags']) if row['tags'] else [],
+                               'timestamp': row['timestamp'], 'updated_at': row['updated_at']}
+            else:
+                cursor.execute(_GET_NOTES_SQL[key], tuple(params))
+                for rows in iter(cursor.fetchmany, []):
+                    for row in rows:
+                        yield self._row_to_note(row)
+        finally:
+            cursor.close()
 
     def get_all_tags(self):
+        cached, generation = self._tags_cache.get()
+        if cached is not None:
+            return cached
         conn = self._get_conn()
         cursor = conn.cursor()
-        cursor.execute("SELECT tags FROM notes WHERE tags IS NOT NULL ORDER BY updated_at DESC")
-        rows = cursor.fetchall()
-        conn.close()
-        all_tags = set()
-        for row in rows:
-            tags = json.loads(row[0])
-            if isinstance(tags, list):
-                all_tags.update(tags)
-        return list(all_tags)
+        cursor.execute("SELECT DISTINCT tag FROM note_tags")
+        tags = [row[0] for row in cursor.fetchall()]
+        # 查询期间若有写入开始或结束，结果可能过期或来自未提交的事务，store 会丢弃它
+        self._tags_cache.store(tags, generation)
+        return list(tags)
 
     def test_connection(self):
         try:
-            self._get_conn()
+            # 实际执行一条查询，连接已关闭或文件不可读时才会报错
+            self._get_conn().execute("SELECT 1").fetchone()
             print("Database connection successful.")
         except sqlite3.Error as e:
             print(f"Database connection failed: {e}")
@@ -125,9 +363,9 @@ class Inbox:
     def delete_note(self, note_id):
         conn = self._get_conn()
         cursor = conn.cursor()
-        cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
-        conn.commit()
-        conn.close()
+        with self._write_lock, self._tags_cache.writing():
+            with conn:
+                cursor.execute("DELETE FROM notes WHERE id = ?", (note_id,))
         return cursor.rowcount > 0  # 返回 True 如果删除成功，否则返回 False
 
 class Note:
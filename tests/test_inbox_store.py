@@ -0,0 +1,312 @@
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+from io import StringIO
+from unittest import mock
+from datetime import datetime, timezone, timedelta
+
+# 直接从仓库根目录导入数据层（不依赖 Flask）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import inbox  # noqa: E402
+from inbox import Inbox  # noqa: E402
+
+BASELINE_SCHEMA = """
+    CREATE TABLE notes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        content TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+        tags TEXT
+    )
+"""
+
+
+class TestInboxStore(unittest.TestCase):
+    def setUp(self):
+        """每个用例在独立的临时目录中使用 test_inbox.db"""
+        self._cwd = os.getcwd()
+        self._tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self._tmpdir.name)
+        self._inboxes = []
+
+    def tearDown(self):
+        for ib in self._inboxes:
+            ib.close()
+        os.chdir(self._cwd)
+        self._tmpdir.cleanup()
+
+    def open_inbox(self):
+        ib = Inbox(testing=True)
+        self._inboxes.append(ib)
+        return ib
+
+    def write_baseline_db(self, rows):
+        conn = sqlite3.connect('test_inbox.db')
+        conn.execute(BASELINE_SCHEMA)
+        conn.executemany("INSERT INTO notes (content, tags) VALUES (?, ?)", rows)
+        conn.commit()
+        conn.close()
+
+    def test_backfill_from_baseline_db(self):
+        """旧格式数据库：只回填合法的 JSON 数组标签，非法值不影响初始化"""
+        self.write_baseline_db([
+            ('a', json.dumps(['work', 'idea'])),
+            ('b', 'not json'),
+            ('c', '"scalar"'),
+            ('d', None),
+            ('e', json.dumps(['work', 'work', 1, None])),
+        ])
+        ib = self.open_inbox()
+        self.assertEqual(sorted(ib.get_all_tags()), ['idea', 'work'])
+        self.assertEqual(sorted(n.data['content'] for n in ib.get_notes(tag='work')), ['a', 'e'])
+
+    def test_failed_init_closes_connection(self):
+        connections = []
+        original_connect = Inbox._connect
+
+        def tracking_connect(self):
+            conn = original_connect(self)
+            connections.append(conn)
+            return conn
+
+        with mock.patch.object(Inbox, '_connect', tracking_connect), \
+                mock.patch.object(Inbox, '_create_schema', side_effect=RuntimeError('boom')):
+            with self.assertRaises(RuntimeError):
+                Inbox(testing=True)
+        [conn] = connections
+        with self.assertRaises(sqlite3.ProgrammingError):
+            conn.execute("SELECT 1")
+
+    def test_test_connection_reports_failure(self):
+        ib = self.open_inbox()
+        out = StringIO()
+        with redirect_stdout(out):
+            ib.test_connection()
+        self.assertIn('successful', out.getvalue())
+
+        ib.close()
+        out = StringIO()
+        with redirect_stdout(out):
+            ib.test_connection()
+        self.assertIn('failed', out.getvalue())
+
+    def test_tags_follow_create_update_delete(self):
+        ib = self.open_inbox()
+        first = ib.create_note('first', ['a', 'b'])
+        second = ib.create_note('second', ['b'])
+        self.assertEqual(sorted(ib.get_all_tags()), ['a', 'b'])
+        self.assertEqual([n.data['id'] for n in ib.get_notes(tag='a')], [first.data['id']])
+
+        ib.update_note(first.data['id'], new_tags=['c'])
+        self.assertEqual(sorted(ib.get_all_tags()), ['b', 'c'])
+        self.assertEqual(ib.get_notes(tag='a'), [])
+        self.assertEqual([n.data['id'] for n in ib.get_notes(tag='c')], [first.data['id']])
+
+        self.assertTrue(ib.delete_note(second.data['id']))
+        self.assertEqual(ib.get_all_tags(), ['c'])
+        self.assertEqual(ib.get_notes(tag='b'), [])
+
+    def test_invalid_tags_rejected(self):
+        """非字符串标签直接报错，且不会写入任何数据；重复标签只记录一次"""
+        ib = self.open_inbox()
+        for bad in ([None], [1], ['a', 2]):
+            with self.assertRaises(TypeError):
+                ib.create_note('bad', bad)
+        self.assertEqual(ib.get_notes(), [])
+
+        note = ib.create_note('ok', ['a', 'a'])
+        with self.assertRaises(TypeError):
+            ib.update_note(note.data['id'], new_content='changed', new_tags=['b', None])
+        [stored] = ib.get_notes()
+        self.assertEqual(stored.data['content'], 'ok')
+        self.assertEqual(ib.get_all_tags(), ['a'])
+        self.assertEqual(ib.update_note(note.data['id'], new_tags=['b', 'b']).data['tags'], ['b', 'b'])
+        self.assertEqual(ib.get_all_tags(), ['b'])
+
+    def test_tag_cache_invalidated_on_write(self):
+        ib = self.open_inbox()
+        self.assertEqual(ib.get_all_tags(), [])
+        note = ib.create_note('x', ['new'])
+        self.assertEqual(ib.get_all_tags(), ['new'])
+        ib.update_note(note.data['id'], new_tags=['renamed'])
+        self.assertEqual(ib.get_all_tags(), ['renamed'])
+        ib.delete_note(note.data['id'])
+        self.assertEqual(ib.get_all_tags(), [])
+
+    def test_api_format_matches_note_timestamps(self):
+        ib = self.open_inbox()
+        created = datetime(2024, 5, 6, 15, 8, 9, 123000, tzinfo=timezone(timedelta(hours=8)))
+        note = ib.create_note('hello', ['t'], created=created)
+
+        [api_note] = ib.get_notes(format='api')
+        [plain_note] = ib.get_notes()
+        self.assertEqual(plain_note.timestamp, created)
+        self.assertEqual(plain_note.timestamp.utcoffset(), timedelta(0))
+        self.assertEqual(api_note['timestamp'], '2024-05-06T07:08:09.123Z')
+        self.assertEqual(api_note['id'], note.data['id'])
+        self.assertEqual(api_note['tags'], ['t'])
+        # SQLite 的 %f 只保留毫秒（四舍五入）
+        updated = datetime.fromisoformat(plain_note.data['updated_at'])
+        api_updated = datetime.strptime(api_note['updated_at'], '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+        self.assertAlmostEqual(api_updated, updated, delta=timedelta(milliseconds=1))
+
+    def test_legacy_timestamps_read_as_utc(self):
+        """CURRENT_TIMESTAMP 写入的旧数据不带时区，读出时按 UTC 处理"""
+        self.write_baseline_db([('a', None)])
+        ib = self.open_inbox()
+        [note] = ib.get_notes()
+        self.assertEqual(note.timestamp.utcoffset(), timedelta(0))
+        self.assertTrue(note.data['updated_at'].endswith('+00:00'))
+
+    def test_create_note_without_returning(self):
+        """SQLite < 3.35 时按 lastrowid 取回新笔记"""
+        ib = self.open_inbox()
+        created = datetime(2024, 1, 1, tzinfo=timezone.utc)
+        with mock.patch.object(inbox, '_HAS_RETURNING', False):
+            note = ib.create_note('old sqlite', ['t'], created=created)
+        self.assertEqual(note.data['content'], 'old sqlite')
+        self.assertEqual(note.data['tags'], ['t'])
+        self.assertEqual(note.timestamp, created)
+        self.assertEqual(ib.get_all_tags(), ['t'])
+        self.assertEqual([n.data['id'] for n in ib.get_notes()], [note.data['id']])
+
+    def test_no_process_wide_datetime_converter(self):
+        """其他以 PARSE_DECLTYPES 打开的连接读取 DATETIME 列时不受 inbox 的 converter 影响"""
+        ib = self.open_inbox()
+        ib.create_note('x')
+        self.assertNotIn('DATETIME', sqlite3.converters)
+        conn = sqlite3.connect('test_inbox.db', detect_types=sqlite3.PARSE_DECLTYPES)
+        try:
+            [(value,)] = conn.execute("SELECT timestamp FROM notes").fetchall()
+        finally:
+            conn.close()
+        self.assertIsInstance(value, str)
+
+    def test_missing_note_id(self):
+        ib = self.open_inbox()
+        self.assertIsNone(ib.update_note(12345, new_content='x', new_tags=['t']))
+        self.assertFalse(ib.delete_note(12345))
+        self.assertEqual(ib.get_all_tags(), [])
+
+    def test_iter_notes_beyond_fetch_batch(self):
+        ib = self.open_inbox()
+        for i in range(300):
+            ib.create_note(str(i), created=datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(seconds=i))
+
+        notes = list(ib.iter_notes(limit=1000))
+        self.assertEqual(len(notes), 300)
+        self.assertEqual(notes[0].data['content'], '299')
+        self.assertEqual(notes[-1].data['content'], '0')
+        self.assertEqual(len(list(ib.iter_notes(limit=200, format='api'))), 200)
+
+    def test_paths_stable_after_chdir(self):
+        """构造后切换工作目录，读写仍使用原来的数据库文件"""
+        ib = self.open_inbox()
+        ib.create_note('x', ['t'])
+        with tempfile.TemporaryDirectory() as other:
+            os.chdir(other)
+            try:
+                self.assertEqual([n.data['content'] for n in ib.iter_notes()], ['x'])
+                ib.create_note('y')
+                self.assertFalse(os.path.exists('test_inbox.db'))
+            finally:
+                os.chdir(self._tmpdir.name)
+        self.assertEqual([n.data['content'] for n in ib.get_notes()], ['y', 'x'])
+
+    def test_schema_recreated_after_db_file_removed(self):
+        """同一路径只建一次表，但文件被删除后会重新建表"""
+        ib = self.open_inbox()
+        ib.create_note('x', ['t'])
+        self.assertIn(os.path.abspath('test_inbox.db'), inbox._INITIALIZED_DBS)
+        self._inboxes.remove(ib)
+        ib.close()
+        for name in os.listdir('.'):
+            if name.startswith('test_inbox.db'):
+                os.remove(name)
+
+        ib = self.open_inbox()
+        self.assertEqual(ib.create_note('y').data['content'], 'y')
+        self.assertEqual(ib.get_all_tags(), [])
+
+    def test_failed_backfill_is_rolled_back_and_retried(self):
+        """回填失败时整体回滚，下次打开会重新回填"""
+        self.write_baseline_db([('a', json.dumps(['work']))])
+        original = Inbox._create_schema
+
+        def failing_schema(cursor):
+            original(cursor)
+            raise RuntimeError('boom')
+
+        Inbox._create_schema = staticmethod(failing_schema)
+        try:
+            with self.assertRaises(RuntimeError):
+                Inbox(testing=True)
+        finally:
+            Inbox._create_schema = staticmethod(original)
+
+        conn = sqlite3.connect('test_inbox.db')
+        has_note_tags = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'note_tags'").fetchone()
+        conn.close()
+        self.assertIsNone(has_note_tags)
+
+        ib = self.open_inbox()
+        self.assertEqual(ib.get_all_tags(), ['work'])
+
+    def test_tag_cache_shared_between_instances(self):
+        """同一数据库文件的多个实例之间，写入会使其他实例的标签缓存失效"""
+        a = self.open_inbox()
+        b = self.open_inbox()
+        self.assertEqual(a.get_all_tags(), [])
+        note = b.create_note('x', ['new'])
+        self.assertEqual(a.get_all_tags(), ['new'])
+        b.delete_note(note.data['id'])
+        self.assertEqual(a.get_all_tags(), [])
+
+    def test_tag_cache_cleared_on_rollback(self):
+        ib = self.open_inbox()
+        note = ib.create_note('x', ['kept'])
+        with self.assertRaises(sqlite3.IntegrityError):
+            # 重复的 (note_id, tag) 会让事务回滚
+            with ib._tags_cache.writing(), ib._conn:
+                ib._conn.execute("INSERT INTO note_tags (note_id, tag) VALUES (?, ?)", (note.data['id'], 'ghost'))
+                self.assertEqual(sorted(ib.get_all_tags()), ['ghost', 'kept'])
+                ib._conn.execute("INSERT INTO note_tags (note_id, tag) VALUES (?, ?)", (note.data['id'], 'kept'))
+        self.assertEqual(ib.get_all_tags(), ['kept'])
+
+    def test_naive_range_filters_bound_unchanged(self):
+        """不带时区的 created_after/created_before 按原样比较（与旧实现一致）"""
+        ib = self.open_inbox()
+        ib.create_note('old', created=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        ib.create_note('new', created=datetime(2022, 1, 1, tzinfo=timezone.utc))
+        notes = ib.get_notes(created_after=datetime(2021, 1, 1), created_before=datetime(2023, 1, 1))
+        self.assertEqual([n.data['content'] for n in notes], ['new'])
+
+    def test_no_process_wide_datetime_adapter(self):
+        """导入 inbox 不应改变其他 sqlite3 连接绑定 datetime 的方式"""
+        adapter = sqlite3.adapters.get((datetime, sqlite3.PrepareProtocol))
+        self.assertNotEqual(getattr(adapter, '__module__', None), inbox.__name__)
+
+    def test_iter_notes_ignores_uncommitted_writes(self):
+        """迭代中途其他写入未提交或回滚，不影响已开始的迭代"""
+        ib = self.open_inbox()
+        for i in range(200):
+            ib.create_note(str(i))
+        it = ib.iter_notes(limit=1000)
+        head = [next(it) for _ in range(5)]
+        with self.assertRaises(RuntimeError):
+            with ib._write_lock, ib._conn:
+                ib._conn.execute("INSERT INTO notes (content) VALUES (?)", ('uncommitted',))
+                rest = list(it)
+                raise RuntimeError('rollback')
+        self.assertEqual(len(head) + len(rest), 200)
+        self.assertNotIn('uncommitted', [n.data['content'] for n in rest])
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=3)